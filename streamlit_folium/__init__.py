@@ -3,18 +3,24 @@ from __future__ import annotations
 import hashlib
 import os
 import re
+import sys
 import warnings
+import weakref
+from itertools import islice
 from textwrap import dedent
-from typing import Iterable
+from typing import TYPE_CHECKING, Any, Callable, Iterable
 
 import branca
 import folium
 import folium.elements
-import folium.plugins
 import streamlit as st
 import streamlit.components.v1 as components
 from jinja2 import UndefinedError
 
+if TYPE_CHECKING:
+    from folium.plugins import DualMap
+    from typing_extensions import TypeGuard
+
 # Create a _RELEASE constant. We'll set this to False while we're developing
 # the component, and True when we're ready to package and distribute it.
 _RELEASE = True
@@ -29,6 +35,9 @@ else:
     build_dir = os.path.join(parent_dir, "frontend/build")
     _component_func = components.declare_component("st_folium", path=build_dir)
 
+_VAR_SUFFIX_RE = re.compile(r"_[a-z0-9]+")
+_MAPS_URL_RE = re.compile(r"maps/[-a-z0-9]+/")
+
 
 def generate_js_hash(
     js_string: str, key: str | None = None, return_on_hover: bool = False
@@ -40,15 +49,30 @@ def generate_js_hash(
     the hash.
 
     Also strip maps/<random_hash>, which is generated by google earth engine
+
+    The pieces are fed to the hasher one at a time rather than concatenated.
+    The key is hashed twice, which keeps the digests identical to the ones
+    produced when the key was appended both before and after stripping the
+    maps/<random_hash> urls.
+
+    The hash is only used as the key of the component, not for anything
+    security sensitive. sha256 is kept because it is hardware accelerated on
+    most current CPUs, where it is faster than blake2b.
     """
-    pattern = r"(_[a-z0-9]+)"
-    standardized_js = re.sub(pattern, "", js_string) + str(key)
-    url_pattern = r"(maps\/[-a-z0-9]+\/)"
-    standardized_js = (
-        re.sub(url_pattern, "", standardized_js) + str(key) + str(return_on_hover)
-    )
-    s = hashlib.sha256(standardized_js.encode()).hexdigest()
-    return s
+    standardized_js = _MAPS_URL_RE.sub("", _VAR_SUFFIX_RE.sub("", js_string))
+    key_bytes = str(key).encode()
+    h = hashlib.sha256(standardized_js.encode())
+    h.update(key_bytes)
+    h.update(key_bytes)
+    h.update(b"True" if return_on_hover else b"False")
+    return h.hexdigest()
+
+
+def _is_dual_map(fig: Any) -> TypeGuard[DualMap]:
+    # folium.plugins is slow to import and not imported by folium itself, but a
+    # DualMap can only exist once the user has imported it
+    plugins = sys.modules.get("folium.plugins")
+    return plugins is not None and isinstance(fig, plugins.DualMap)
 
 
 def folium_static(
@@ -99,60 +123,79 @@ def folium_static(
         )
 
     # if DualMap, get HTML representation
-    elif isinstance(fig, folium.plugins.DualMap) or isinstance(
-        fig, branca.element.Figure
-    ):
+    elif _is_dual_map(fig) or isinstance(fig, branca.element.Figure):
         return components.html(fig._repr_html_(), height=height + 10, width=width)
     return st_folium(fig, width=width, height=height, returned_objects=[])
 
 
 def _get_siblings(fig: folium.MacroElement) -> str:
     """Get the html for any siblings of the map"""
-    children = list(fig.get_root()._children.values())
-
     html = ""
-    if len(children) > 1:
-        for child in children[1:]:
-            try:
-                html += child._template.module.html() + "\n"
-            except Exception:
-                pass
+    for child in islice(fig.get_root()._children.values(), 1, None):
+        try:
+            html += child._template.module.html() + "\n"
+        except Exception:
+            pass
 
     return html
 
 
 def get_full_id(m: folium.MacroElement) -> str:
-    if isinstance(m, folium.plugins.DualMap):
+    if _is_dual_map(m):
         m = m.m1
 
     return f"{m._name.lower()}_{m._id}"
 
 
-def _get_map_string(fig: folium.Map) -> str:
-    leaflet = generate_leaflet_string(fig)
+_UNINDENTED_LINE_RE = re.compile(r"^\S", re.MULTILINE)
+_WHITESPACE_ONLY_LINE_RE = re.compile(r"^[ \t]+$", re.MULTILINE)
 
-    # Get rid of the annoying popup
-    leaflet = leaflet.replace("alert(coords);", "")
 
-    # Rename drawnItems
-    leaflet = leaflet.replace("drawnItems_draw_control_div_1", "drawnItems")
+def _dedent(text: str) -> str:
+    """Same as textwrap.dedent, but returns early when a line isn't indented,
+    which is the common case for the scripts generated by recent folium versions"""
+    if _UNINDENTED_LINE_RE.search(text):
+        return _WHITESPACE_ONLY_LINE_RE.sub("", text)
+    return dedent(text)
 
-    leaflet = dedent(leaflet)
 
-    if "drawnItems" not in leaflet:
-        leaflet += "\nvar drawnItems = [];"
+def _apply_map_fixups(leaflet: str) -> str:
+    # Get rid of the annoying popup, and rename drawnItems
+    return leaflet.replace("alert(coords);", "").replace(
+        "drawnItems_draw_control_div_1", "drawnItems"
+    )
+
+
+def _get_map_string(fig: folium.Map, rendered: bool = False) -> str:
+    leaflet = generate_leaflet_string(fig, rendered=rendered)
+
+    leaflet = _apply_map_fixups(leaflet)
 
     # Replace the folium generated map_{random characters} variables
     # with map_div and map_div2 (these end up being both the assumed)
     # div id where the maps are inserted into the DOM, and the names of
     # the variables themselves.
-    if isinstance(fig, folium.plugins.DualMap):
+    if _is_dual_map(fig):
         m2_id = get_full_id(fig.m2)
         leaflet = leaflet.replace(m2_id, "map_div2")
 
+    leaflet = _dedent(leaflet)
+
+    if "drawnItems" not in leaflet:
+        leaflet += "\nvar drawnItems = [];"
+
     return leaflet
 
 
+_FEATURE_GROUP_SCRIPT = dedent(
+    """
+    map_div.addLayer(feature_group_feature_group_{idx});
+    window.feature_group = window.feature_group || [];
+    window.feature_group.push(feature_group_feature_group_{idx});
+    """
+)
+
+
 def _get_feature_group_string(
     feature_group_to_add: folium.FeatureGroup,
     map: folium.Map,
@@ -166,19 +209,20 @@ def _get_feature_group_string(
     )
     m_id = get_full_id(map)
     feature_group_string = feature_group_string.replace(m_id, "map_div")
-    feature_group_string = dedent(feature_group_string)
+    feature_group_string = _dedent(feature_group_string)
 
-    feature_group_string += dedent(
-        f"""
-        map_div.addLayer(feature_group_feature_group_{idx});
-        window.feature_group = window.feature_group || [];
-        window.feature_group.push(feature_group_feature_group_{idx});
-        """
-    )
+    feature_group_string += _FEATURE_GROUP_SCRIPT.format(idx=idx)
 
     return feature_group_string
 
 
+_LAYER_CONTROL_SCRIPT = dedent(
+    """
+    window.layer_control = layer_control_layer_control;
+    """
+)
+
+
 def _get_layer_control_string(
     control: folium.LayerControl,
     map: folium.Map,
@@ -189,16 +233,137 @@ def _get_layer_control_string(
     control_string = generate_leaflet_string(control, base_id="layer_control")
     m_id = get_full_id(map)
     control_string = control_string.replace(m_id, "map_div")
-    control_string = dedent(control_string)
-    control_string += dedent(
-        """
-        window.layer_control = layer_control_layer_control;
-        """
-    )
+    control_string = _dedent(control_string)
+    control_string += _LAYER_CONTROL_SCRIPT
 
     return control_string
 
 
+def _get_links(fig: folium.MacroElement) -> tuple[list[str], list[str]]:
+    """Get the css and js links needed by the elements of the map, without
+    duplicates, in the order the elements appear"""
+    # dicts are used as insertion ordered sets
+    css_links: dict[str, None] = {}
+    js_links: dict[str, None] = {}
+    has_colormap = False
+
+    # Each entry is an element, and whether to collect its links (True) or to
+    # expand it into its maps and children (False)
+    stack: list[tuple[Any, bool]] = [(fig, False)]
+    while stack:
+        elem, collect = stack.pop()
+        if not collect:
+            pending: list[tuple[Any, bool]] = []
+            if isinstance(elem, branca.colormap.ColorMap):
+                pending.append((elem, True))
+            if _is_dual_map(elem):
+                pending.extend([(elem.m1, False), (elem.m2, False)])
+            if isinstance(elem, folium.elements.JSCSSMixin):
+                pending.append((elem, True))
+            if hasattr(elem, "_children"):
+                pending.extend((child, False) for child in elem._children.values())
+            stack.extend(reversed(pending))
+            continue
+
+        if isinstance(elem, branca.colormap.ColorMap):
+            has_colormap = True
+        css_links.update(
+            dict.fromkeys(href for _, href in getattr(elem, "default_css", []))
+        )
+        js_links.update(
+            dict.fromkeys(src for _, src in getattr(elem, "default_js", []))
+        )
+
+    if has_colormap:
+        # manually add d3.js, ahead of everything else
+        d3_links = dict.fromkeys(
+            [
+                "https://d3js.org/d3.v4.min.js",
+                "https://cdnjs.cloudflare.com/ajax/libs/d3/3.5.5/d3.min.js",
+            ]
+        )
+        d3_links.update(js_links)
+        js_links = d3_links
+
+    return list(css_links), list(js_links)
+
+
+def _bounds_to_dict(
+    bounds_list: list[list[float | None]],
+) -> dict[str, dict[str, float | None]]:
+    southwest, northeast = bounds_list
+    return {
+        "_southWest": {
+            "lat": southwest[0],
+            "lng": southwest[1],
+        },
+        "_northEast": {
+            "lat": northeast[0],
+            "lng": northeast[1],
+        },
+    }
+
+
+def _get_bounds(folium_map: folium.Map) -> dict[str, dict[str, float | None]]:
+    try:
+        bounds = folium_map.get_bounds()
+    except AttributeError:
+        bounds = [[None, None], [None, None]]
+    return _bounds_to_dict(bounds)
+
+
+def _get_zoom(folium_map: folium.Map) -> Any:
+    return folium_map.options.get("zoom") if hasattr(folium_map, "options") else {}
+
+
+# The values st_folium returns before the user has interacted with the map, and
+# how to get each of them from the map. Only the returned ones are computed.
+_DEFAULTS: tuple[tuple[str, Callable[[folium.Map], Any]], ...] = (
+    ("last_clicked", lambda _: None),
+    ("last_object_clicked", lambda _: None),
+    ("last_object_clicked_tooltip", lambda _: None),
+    ("last_object_clicked_popup", lambda _: None),
+    ("all_drawings", lambda _: None),
+    ("last_active_drawing", lambda _: None),
+    ("bounds", _get_bounds),
+    ("zoom", _get_zoom),
+    ("last_circle_radius", lambda _: None),
+    ("last_circle_polygon", lambda _: None),
+)
+
+
+def _get_defaults(
+    folium_map: folium.Map, returned_objects: Iterable[str] | None
+) -> dict[str, Any]:
+    # If the user passes a custom list of returned objects, we'll only return
+    # those. The others, like the bounds which walk the whole map, are skipped.
+    return {
+        k: get_default(folium_map)
+        for k, get_default in _DEFAULTS
+        if returned_objects is None or k in returned_objects
+    }
+
+
+# Rendered output of maps passed to st_folium with cache_rendering=True, reused
+# on reruns where the same map object is passed in again without any elements
+# being added or removed.
+_RENDER_CACHE: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _tree_signature(fig: branca.element.Element) -> tuple[int, ...]:
+    """Get the identities of every element in the tree of the map, in order"""
+    signature = []
+    stack: list[Any] = [fig.get_root()]
+    while stack:
+        elem = stack.pop()
+        signature.append(id(elem))
+        if _is_dual_map(elem):
+            stack.extend([elem.m1, elem.m2])
+        if hasattr(elem, "_children"):
+            stack.extend(elem._children.values())
+    return tuple(signature)
+
+
 def st_folium(
     fig: folium.MacroElement,
     key: str | None = None,
@@ -216,6 +381,7 @@ def st_folium(
     render: bool = True,
     max_drawn_objects: int = 0,
     max_drawn_objects_remove_old: bool = True,
+    cache_rendering: bool = False,
 ):
     """Display a Folium object in Streamlit, returning data as user interacts
     with app.
@@ -278,6 +444,13 @@ def st_folium(
         newest
         object drawn will be removed, preventing the user from adding more draw objects
         to the map. Only works then max_drawn_objects is not 0
+    cache_rendering: bool
+        If True, reuse the generated html and javascript when the same map object
+        is passed again without any elements added or removed, e.g. a map kept in
+        `st.cache_resource`. Changes made to existing elements in place (such as a
+        new marker location) are *not* picked up, so only enable this for maps
+        that aren't modified after they're created. Ignored when
+        feature_group_to_add or layer_control are passed.
     Returns
     -------
     dict
@@ -294,62 +467,38 @@ def st_folium(
         width = None
 
     folium_map: folium.Map = fig  # type: ignore
-    if render:
-        folium_map.render()
 
     # handle the case where you pass in a figure rather than a map
     # this assumes that a map is the first child
-    if not (isinstance(fig, folium.Map) or isinstance(fig, folium.plugins.DualMap)):
-        folium_map = list(fig._children.values())[0]
-
-    folium_map.render()
-
-    leaflet = _get_map_string(folium_map)  # type: ignore
-
-    html = _get_siblings(folium_map)
+    if not (isinstance(fig, folium.Map) or _is_dual_map(fig)):
+        folium_map = next(iter(fig._children.values()))
 
-    m_id = get_full_id(folium_map)
+    # Dynamically added feature groups and layer controls are added to the map
+    # itself, so its rendering can only be reused when there are none.
+    use_cache = (
+        cache_rendering and feature_group_to_add is None and layer_control is None
+    )
+    cached = _RENDER_CACHE.get(folium_map) if use_cache else None
+    if cached is not None and cached[0] != _tree_signature(folium_map):
+        cached = None
 
-    def bounds_to_dict(bounds_list: list[list[float]]) -> dict[str, dict[str, float]]:
-        southwest, northeast = bounds_list
-        return {
-            "_southWest": {
-                "lat": southwest[0],
-                "lng": southwest[1],
-            },
-            "_northEast": {
-                "lat": northeast[0],
-                "lng": northeast[1],
-            },
-        }
+    if cached is not None:
+        _, leaflet, html, css_links, js_links, js_hashes = cached
+    else:
+        # Rendering the figure renders the map too. Without it, the map is still
+        # rendered, since the script can't be generated otherwise.
+        if render:
+            fig.render()
+        else:
+            folium_map.render()
 
-    try:
-        bounds = folium_map.get_bounds()
-    except AttributeError:
-        bounds = [[None, None], [None, None]]
+        leaflet = _get_map_string(folium_map, rendered=True)  # type: ignore
 
-    _defaults = {
-        "last_clicked": None,
-        "last_object_clicked": None,
-        "last_object_clicked_tooltip": None,
-        "last_object_clicked_popup": None,
-        "all_drawings": None,
-        "last_active_drawing": None,
-        "bounds": bounds_to_dict(bounds),
-        "zoom": folium_map.options.get("zoom")
-        if hasattr(folium_map, "options")
-        else {},
-        "last_circle_radius": None,
-        "last_circle_polygon": None,
-    }
+        html = _get_siblings(folium_map)
 
-    # If the user passes a custom list of returned objects, we'll only return those
+    m_id = get_full_id(folium_map)
 
-    defaults = {
-        k: v
-        for k, v in _defaults.items()
-        if returned_objects is None or k in returned_objects
-    }
+    defaults = _get_defaults(folium_map, returned_objects)
 
     # Convert the feature group to a javascript string which can be used to create it
     # on the frontend.
@@ -386,36 +535,32 @@ def st_folium(
                 st.info("Layer control js:")
                 st.code(layer_control_string)
 
-    def walk(fig):
-        if isinstance(fig, branca.colormap.ColorMap):
-            yield fig
-        if isinstance(fig, folium.plugins.DualMap):
-            yield from walk(fig.m1)
-            yield from walk(fig.m2)
-        if isinstance(fig, folium.elements.JSCSSMixin):
-            yield fig
-        if hasattr(fig, "_children"):
-            for child in fig._children.values():
-                yield from walk(child)
-
-    css_links: list[str] = []
-    js_links: list[str] = []
-
-    for elem in walk(folium_map):
-        if isinstance(elem, branca.colormap.ColorMap):
-            # manually add d3.js
-            js_links.insert(
-                0, "https://cdnjs.cloudflare.com/ajax/libs/d3/3.5.5/d3.min.js"
+    if cached is None:
+        css_links, js_links = _get_links(folium_map)
+        # Component keys already generated from this script, by hash arguments
+        js_hashes = {}
+
+        if use_cache:
+            _RENDER_CACHE[folium_map] = (
+                _tree_signature(folium_map),
+                leaflet,
+                html,
+                css_links,
+                js_links,
+                js_hashes,
             )
-            js_links.insert(0, "https://d3js.org/d3.v4.min.js")
-        css_links.extend([href for _, href in getattr(elem, "default_css", [])])
-        js_links.extend([src for _, src in getattr(elem, "default_js", [])])
+
+    # The key has to change with the script, since the frontend only runs the
+    # script when the component is mounted
+    hash_args = (f"{key}_{max_drawn_objects}", return_on_hover)
+    if hash_args not in js_hashes:
+        js_hashes[hash_args] = generate_js_hash(leaflet, *hash_args)
 
     component_value = _component_func(
         script=leaflet,
         html=html,
         id=m_id,
-        key=generate_js_hash(leaflet, f"{key}_{max_drawn_objects}", return_on_hover),
+        key=js_hashes[hash_args],
         height=height,
         width=width,
         returned_objects=returned_objects,
@@ -435,15 +580,9 @@ def st_folium(
     return component_value
 
 
-def _generate_leaflet_string(
-    m: folium.MacroElement,
-    nested: bool = True,
-    base_id: str = "0",
-    mappings: dict[str, str] | None = None,
-) -> tuple[str, dict[str, str]]:
-    if mappings is None:
-        mappings = {}
-
+def _set_element_id(
+    m: folium.MacroElement, base_id: str, mappings: dict[str, str]
+) -> None:
     mappings[m._id] = base_id
     try:
         element_id = m.element_name.replace("map_", "").replace("tile_layer_", "")
@@ -457,57 +596,97 @@ def _generate_leaflet_string(
 
     m._id = base_id
 
-    if isinstance(m, folium.plugins.DualMap):
-        m.render()
-        m.m1.render()
-        m.m2.render()
-        if not nested:
-            return _generate_leaflet_string(
-                m.m1, nested=False, mappings=mappings, base_id=base_id
-            )
-        # Generate the script for map1
-        leaflet, _ = _generate_leaflet_string(
-            m.m1, nested=nested, mappings=mappings, base_id=base_id
-        )
-        # Add the script for map2
-        leaflet += (
-            "\n"
-            + _generate_leaflet_string(
-                m.m2, nested=nested, mappings=mappings, base_id="div2"
-            )[0]
-        )
-        # Add the script that syncs them together
-        leaflet += m._template.module.script(m)
-        return leaflet, mappings
 
+def _get_element_script(m: folium.MacroElement) -> str:
     try:
-        leaflet = m._template.module.script(m)
+        return m._template.module.script(m)
     except UndefinedError:
         # Correctly render Popup elements, and perhaps others. Not sure why
         # this is necessary. Some deep magic related to jinja2 templating, perhaps.
-        leaflet = m._template.render(this=m, kwargs={})
+        return m._template.render(this=m, kwargs={})
 
-    if not nested:
-        return leaflet, mappings
 
-    for idx, child in enumerate(m._children.values()):
+def _generate_element_leaflet_string(
+    m: folium.MacroElement,
+    nested: bool,
+    base_id: str,
+    mappings: dict[str, str],
+) -> str:
+    """Generate the script for an element other than a DualMap, and its children"""
+    _set_element_id(m, base_id, mappings)
+
+    leaflet = _get_element_script(m)
+
+    if not nested:
+        return leaflet
+
+    # Walk the children depth first, collecting the script of each element in
+    # the order they appear. An element that can't be rendered is skipped along
+    # with all of its children.
+    parts = [leaflet]
+    stack: list[tuple[Any, str]] = [
+        (child, f"{base_id}_{idx}") for idx, child in enumerate(m._children.values())
+    ]
+    stack.reverse()
+    while stack:
+        child, child_id = stack.pop()
         try:
-            leaflet += (
-                "\n"
-                + _generate_leaflet_string(
-                    child, base_id=f"{base_id}_{idx}", mappings=mappings
-                )[0]
-            )
+            _set_element_id(child, child_id, mappings)
+            script = _get_element_script(child)
+            grandchildren = [
+                (grandchild, f"{child_id}_{idx}")
+                for idx, grandchild in enumerate(child._children.values())
+            ]
         except (UndefinedError, AttributeError):
-            pass
+            continue
+        parts.append(script)
+        stack.extend(reversed(grandchildren))
+
+    return "\n".join(parts)
+
+
+def _generate_leaflet_string(
+    m: folium.MacroElement,
+    nested: bool = True,
+    base_id: str = "0",
+    mappings: dict[str, str] | None = None,
+    rendered: bool = False,
+) -> tuple[str, dict[str, str]]:
+    if mappings is None:
+        mappings = {}
+
+    # Only the element passed in can be a DualMap, everything under it is
+    # handled by _generate_element_leaflet_string
+    if not _is_dual_map(m):
+        return _generate_element_leaflet_string(m, nested, base_id, mappings), mappings
 
-    return leaflet, mappings
+    _set_element_id(m, base_id, mappings)
+    if not rendered:
+        m.render()
+    m.m1.render()
+    m.m2.render()
+    if not nested:
+        return (
+            _generate_element_leaflet_string(m.m1, False, base_id, mappings),
+            mappings,
+        )
+    parts = [
+        # Generate the script for map1
+        _generate_element_leaflet_string(m.m1, True, base_id, mappings),
+        # Add the script for map2
+        _generate_element_leaflet_string(m.m2, True, "div2", mappings),
+    ]
+    # Add the script that syncs them together
+    return "\n".join(parts) + m._template.module.script(m), mappings
 
 
 _FOLIUM_VAR_SUFFIX_PATTERN = re.compile("_[a-z0-9]+(?!_)")
 
 
 def _replace_folium_vars(leaflet: str, mappings: dict[str, str]) -> str:
+    if not mappings:
+        return leaflet
+
     def replace(match: re.Match):
         match_str = match.group()
         leaflet_id = match_str.strip("_")
@@ -520,7 +699,10 @@ def _replace_folium_vars(leaflet: str, mappings: dict[str, str]) -> str:
 
 
 def generate_leaflet_string(
-    m: folium.MacroElement, nested: bool = True, base_id: str = "div"
+    m: folium.MacroElement,
+    nested: bool = True,
+    base_id: str = "div",
+    rendered: bool = False,
 ) -> str:
     """
     Call the _generate_leaflet_string function, and then replace the
@@ -531,8 +713,13 @@ def generate_leaflet_string(
 
     This also allows the output to be more testable, since the
     variable names are consistent.
+
+    Pass rendered=True if `m` has just been rendered, so that a DualMap
+    isn't rendered a second time.
     """
-    leaflet, mappings = _generate_leaflet_string(m, nested=nested, base_id=base_id)
+    leaflet, mappings = _generate_leaflet_string(
+        m, nested=nested, base_id=base_id, rendered=rendered
+    )
 
     leaflet = _replace_folium_vars(leaflet, mappings)
 
@@ -117,3 +117,174 @@ def test_vector_grid():
     VectorGridProtobuf(url, "test").add_to(m)
     leaflet = _get_map_string(m)
     assert "var vector_grid_protobuf_div_1 = L.vectorGrid.protobuf(" in leaflet
+
+
+def test_render_cache(monkeypatch):
+    import folium
+
+    import streamlit_folium
+    from streamlit_folium import st_folium
+
+    calls = []
+    monkeypatch.setattr(
+        streamlit_folium, "_component_func", lambda **kwargs: calls.append(kwargs)
+    )
+
+    m = folium.Map()
+    st_folium(m, cache_rendering=True)
+    st_folium(m, cache_rendering=True)
+    assert calls[0]["script"] == calls[1]["script"]
+    assert calls[0]["key"] == calls[1]["key"]
+
+    folium.Marker([0, 0]).add_to(m)
+    st_folium(m, cache_rendering=True)
+    assert "L.marker(" not in calls[1]["script"]
+    assert "L.marker(" in calls[2]["script"]
+
+
+def test_render_in_place_changes(monkeypatch):
+    import folium
+
+    import streamlit_folium
+    from streamlit_folium import st_folium
+
+    calls = []
+    monkeypatch.setattr(
+        streamlit_folium, "_component_func", lambda **kwargs: calls.append(kwargs)
+    )
+
+    m = folium.Map()
+    marker = folium.Marker([1, 2]).add_to(m)
+    st_folium(m)
+    marker.location = [45.5, 66.5]
+    st_folium(m)
+    assert "45.5" not in calls[0]["script"]
+    assert "45.5" in calls[1]["script"]
+
+
+def test_leaflet_string_in_place_changes():
+    import folium
+
+    from streamlit_folium import generate_leaflet_string
+
+    m = folium.Map()
+    marker = folium.Marker([1, 2]).add_to(m)
+    m.render()
+    assert "45.5" not in generate_leaflet_string(m)
+
+    marker.location = [45.5, 66.5]
+    assert "45.5" in generate_leaflet_string(m)
+
+
+def test_links():
+    import branca.colormap
+    import folium.plugins
+
+    from streamlit_folium import _get_links
+
+    m = folium.Map()
+    folium.plugins.MarkerCluster().add_to(m)
+    folium.plugins.MarkerCluster().add_to(m)
+    branca.colormap.linear.YlGn_09.add_to(m)
+    branca.colormap.linear.Reds_09.add_to(m)
+
+    class D3Element(folium.elements.JSCSSMixin, folium.MacroElement):
+        default_js = [("d3", "https://d3js.org/d3.v4.min.js")]
+
+    D3Element().add_to(m)
+
+    css_links, js_links = _get_links(m)
+    assert len(css_links) == len(set(css_links))
+    assert len(js_links) == len(set(js_links))
+    assert js_links[0] == "https://d3js.org/d3.v4.min.js"
+    assert any("markercluster" in link for link in js_links)
+
+
+def test_defaults(monkeypatch):
+    import folium
+
+    from streamlit_folium import _get_defaults
+
+    m = folium.Map()
+    assert _get_defaults(m, None)["zoom"] == m.options["zoom"]
+    assert _get_defaults(m, None)["bounds"]["_southWest"] == {
+        "lat": None,
+        "lng": None,
+    }
+
+    def get_bounds():
+        raise AssertionError("bounds should not be computed")
+
+    monkeypatch.setattr(m, "get_bounds", get_bounds)
+    assert _get_defaults(m, ["last_clicked"]) == {"last_clicked": None}
+
+
+def test_replace_folium_vars():
+    from streamlit_folium import _replace_folium_vars
+
+    cases = [
+        (
+            "marker_ab.addTo(map_cd);",
+            {"ab": "div_1", "cd": "div"},
+            "marker_div_1.addTo(map_div);",
+        ),
+        # a run followed by "_" loses its last character before lookup
+        ("marker_ab_x", {"ab": "div"}, "marker_ab_x"),
+        ("marker_ab_x", {"a": "div"}, "marker_divb_x"),
+        # a one-character id before "_" is never replaced
+        ("x_a_y", {"a": "div"}, "x_a_y"),
+        # unmapped ids are left alone
+        ("marker_cd", {"ab": "div"}, "marker_cd"),
+        ("marker_abc", {"ab": "div"}, "marker_abc"),
+    ]
+    for text, mappings, expected in cases:
+        assert _replace_folium_vars(text, mappings) == expected
+
+
+def test_replace_folium_vars_random_ids():
+    from streamlit_folium import _replace_folium_vars
+
+    marker_id = "0123456789abcdef" * 2
+    map_id = "fedcba9876543210" * 2
+    mappings = {marker_id: "div_1", map_id: "div"}
+    text = (
+        f"var marker_{marker_id} = L.marker(); "
+        f"marker_{marker_id}.addTo(map_{map_id});"
+    )
+    expected = "var marker_div_1 = L.marker(); marker_div_1.addTo(map_div);"
+    assert _replace_folium_vars(text, mappings) == expected
+
+    # an id directly followed by "_" is not replaced
+    continued = f" tooltip_{marker_id}_x;"
+    assert _replace_folium_vars(text + continued, mappings) == expected + continued
+
+    # replacements are not chained, even when one is itself a mapped id
+    mappings = {marker_id: map_id, map_id: "div"}
+    assert _replace_folium_vars(f"marker_{marker_id};", mappings) == (
+        f"marker_{map_id};"
+    )
+
+
+def test_render_false(monkeypatch):
+    import folium
+
+    import streamlit_folium
+    from streamlit_folium import st_folium
+
+    calls = []
+    monkeypatch.setattr(
+        streamlit_folium, "_component_func", lambda **kwargs: calls.append(kwargs)
+    )
+
+    # The map is still rendered, only rendering the figure is skipped
+    m = folium.Map()
+    folium.Marker([0, 0]).add_to(m)
+    st_folium(m, render=False)
+
+    fig = folium.Figure()
+    m = folium.Map().add_to(fig)
+    folium.Marker([0, 0]).add_to(m)
+    st_folium(fig, render=False)
+
+    for call in calls:
+        assert "tile_layer_div_0.addTo(map_div);" in call["script"]